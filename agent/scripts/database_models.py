@@ -7,14 +7,16 @@ import os
 import logging
 from datetime import datetime
 from typing import Optional, List
-from contextlib import contextmanager
+from contextlib import asynccontextmanager
 
 from sqlalchemy import (
-    create_engine, Column, Integer, String, Text, Float, Boolean, DateTime,
+    event, select, Column, Integer, String, Text, Float, Boolean, DateTime,
     ForeignKey, Index, CheckConstraint, UniqueConstraint, JSON
 )
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.orm import relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool, StaticPool
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -29,17 +31,48 @@ if DATABASE_URL.startswith("sqlite"):
     db_path = DATABASE_URL.replace("sqlite:///", "").replace("sqlite://", "")
     os.makedirs(os.path.dirname(db_path) if os.path.dirname(db_path) else ".", exist_ok=True)
 
+# Use the async SQLite driver so queries can be awaited instead of blocking
+# the event loop on disk I/O
+if DATABASE_URL.startswith("sqlite:"):
+    DATABASE_URL = DATABASE_URL.replace("sqlite:", "sqlite+aiosqlite:", 1)
+
+# Pool configuration - keep a persistent pool of connections so warm requests
+# reuse file descriptors and the SQLite page cache instead of reopening the
+# db/-wal/-shm files on every checkout (StaticPool doesn't take sizing args)
+if ":memory:" in DATABASE_URL:
+    pool_settings = {"poolclass": StaticPool}
+else:
+    pool_settings = {
+        "poolclass": AsyncAdaptedQueuePool,
+        "pool_size": 5,
+        "max_overflow": 10,
+        "pool_recycle": 3600,
+    }
+
 # Create engine
-engine = create_engine(
+engine = create_async_engine(
     DATABASE_URL,
     echo=os.getenv("DEBUG", "False").lower() == "true",
     pool_pre_ping=True,
-    # SQLite specific settings
-    connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
+    **pool_settings
 )
 
-# Create session factory
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# SQLite performance tuning - WAL allows concurrent readers alongside a writer
+# and synchronous=NORMAL batches fsyncs, which matters for our write-heavy endpoints
+if DATABASE_URL.startswith("sqlite"):
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragma(dbapi_conn, connection_record):
+        cursor = dbapi_conn.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")  # 256MB memory-mapped I/O
+        cursor.execute("PRAGMA cache_size=-65536")    # 64MB page cache
+        cursor.close()
+
+# Create session factory - expire_on_commit=False so committed objects stay
+# readable after the transaction without re-fetching
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
 
 # Base class for all models
 Base = declarative_base()
@@ -62,14 +95,16 @@ class ConversationLog(Base):
     user_ip = Column(String(45))  # Support IPv6
     user_agent = Column(Text)
     conversation_context = Column(JSON)  # For additional context
-    metadata = Column(JSON)  # For additional metadata
+    # 'metadata' is reserved by declarative Base, so the attribute gets a
+    # different name while the column keeps matching the SQLite schema
+    extra_metadata = Column('metadata', JSON)  # For additional metadata
     created_at = Column(DateTime, default=datetime.utcnow)
     
-    # Indexes
+    # Indexes - the 3-column index matches the chat history predicate
+    # (session_id = ? AND success = ? ORDER BY timestamp DESC) exactly,
+    # so SQLite can answer it with a bounded backward index walk
     __table_args__ = (
-        Index('idx_conversation_session_timestamp', 'session_id', 'timestamp'),
-        Index('idx_conversation_tokens', 'tokens_used'),
-        Index('idx_conversation_processing_time', 'processing_time'),
+        Index('idx_conv_session_success_ts', 'session_id', 'success', 'timestamp'),
         Index('idx_conversation_model_timestamp', 'model_used', 'timestamp'),
         CheckConstraint('tokens_used >= 0', name='chk_tokens_positive'),
         CheckConstraint('processing_time >= 0', name='chk_processing_time_positive'),
@@ -102,10 +137,13 @@ class UserSession(Base):
     session_rating = Column(Integer)  # 1-5 rating
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
-    # Relationship to conversations
-    conversations = relationship("ConversationLog", 
+    # Relationship to conversations - lazy='raise' so accidental lazy loads
+    # fail loudly instead of silently becoming N+1 queries; callers that
+    # really need the rows must use .options(selectinload(...))
+    conversations = relationship("ConversationLog",
                                primaryjoin="UserSession.session_uuid == foreign(ConversationLog.session_id)",
-                               viewonly=True)
+                               viewonly=True,
+                               lazy='raise')
     
     __table_args__ = (
         Index('idx_session_activity', 'last_activity'),
@@ -155,4 +193,147 @@ class SystemMetrics(Base):
     health_status = Column(String(20), default="healthy")  # healthy, warning, critical
     created_at = Column(DateTime, default=datetime.utcnow)
     
-    __table_args__ =
+    __table_args__ = (
+        Index('idx_metrics_date', 'metric_date'),
+        Index('idx_metrics_health', 'health_status', 'timestamp'),
+        CheckConstraint('cpu_percent IS NULL OR (cpu_percent >= 0 AND cpu_percent <= 100)',
+                       name='chk_cpu_percent_range'),
+        CheckConstraint('memory_percent IS NULL OR (memory_percent >= 0 AND memory_percent <= 100)',
+                       name='chk_memory_percent_range'),
+        CheckConstraint('active_sessions >= 0', name='chk_active_sessions_positive'),
+    )
+    
+    def __repr__(self):
+        return f"<SystemMetrics(id={self.id}, timestamp={self.timestamp}, health={self.health_status})>"
+
+class APIUsage(Base):
+    """Track detailed API usage, costs, and billing information"""
+    __tablename__ = "api_usage"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    usage_date = Column(String(10), default=lambda: datetime.utcnow().strftime('%Y-%m-%d'), index=True)
+    hour_of_day = Column(Integer)
+    total_tokens = Column(Integer, default=0)
+    input_tokens = Column(Integer, default=0)
+    output_tokens = Column(Integer, default=0)
+    total_requests = Column(Integer, default=0)
+    successful_requests = Column(Integer, default=0)
+    failed_requests = Column(Integer, default=0)
+    rate_limited_requests = Column(Integer, default=0)
+    estimated_cost_usd = Column(Float, default=0.0)
+    actual_cost_usd = Column(Float)
+    model_usage = Column(JSON)  # Per-model usage breakdown
+    cost_breakdown = Column(JSON)  # Detailed cost analysis
+    billing_tier = Column(String(50))
+    cost_alerts = Column(JSON)  # Cost threshold alerts
+    peak_requests_per_minute = Column(Integer, default=0)
+    unique_sessions = Column(Integer, default=0)
+    avg_tokens_per_request = Column(Float, default=0.0)
+    cost_per_request = Column(Float, default=0.0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('usage_date', 'hour_of_day', name='uq_api_usage_date_hour'),
+        Index('idx_api_usage_tokens', 'total_tokens'),
+        CheckConstraint('total_tokens >= 0', name='chk_api_tokens_positive'),
+        CheckConstraint('total_requests >= 0', name='chk_api_requests_positive'),
+        CheckConstraint('hour_of_day IS NULL OR (hour_of_day >= 0 AND hour_of_day <= 23)',
+                       name='chk_hour_of_day_range'),
+    )
+    
+    def __repr__(self):
+        return f"<APIUsage(id={self.id}, usage_date={self.usage_date}, total_requests={self.total_requests})>"
+
+class ErrorLog(Base):
+    """Dedicated table for tracking and analyzing errors"""
+    __tablename__ = "error_logs"
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    timestamp = Column(DateTime, default=datetime.utcnow, index=True)
+    error_type = Column(String(50), nullable=False)
+    error_code = Column(String(50))
+    error_message = Column(Text, nullable=False)
+    error_context = Column(JSON)  # Additional error context
+    session_id = Column(String(255), index=True)
+    request_id = Column(String(255))
+    user_ip = Column(String(45))
+    user_agent = Column(Text)
+    stack_trace = Column(Text)
+    resolution_status = Column(String(20), default="open")  # open, investigating, resolved, ignored
+    resolution_notes = Column(Text)
+    severity_level = Column(Integer, default=3)  # 1=critical, 5=minor
+    affected_users = Column(Integer, default=1)
+    resolved_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('idx_error_type', 'error_type', 'timestamp'),
+        Index('idx_error_severity', 'severity_level', 'timestamp'),
+        Index('idx_error_resolution', 'resolution_status', 'timestamp'),
+        CheckConstraint('severity_level >= 1 AND severity_level <= 5',
+                       name='chk_severity_level_range'),
+    )
+    
+    def __repr__(self):
+        return f"<ErrorLog(id={self.id}, error_type={self.error_type}, severity={self.severity_level})>"
+
+class SystemCounters(Base):
+    """Single-row roll-up of aggregate stats, maintained by the chat write path"""
+    __tablename__ = "system_counters"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    total_conversations = Column(Integer, default=0, nullable=False)
+    successful_conversations = Column(Integer, default=0, nullable=False)
+    total_sessions = Column(Integer, default=0, nullable=False)
+    active_sessions_24h = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        CheckConstraint('total_conversations >= 0', name='chk_counter_conversations_positive'),
+        CheckConstraint('successful_conversations >= 0', name='chk_counter_successful_positive'),
+        CheckConstraint('total_sessions >= 0', name='chk_counter_sessions_positive'),
+        CheckConstraint('active_sessions_24h >= 0', name='chk_counter_active_positive'),
+    )
+
+    def __repr__(self):
+        return f"<SystemCounters(total_conversations={self.total_conversations}, total_sessions={self.total_sessions})>"
+
+async def get_db():
+    """Dependency for getting database sessions"""
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        await db.close()
+
+@asynccontextmanager
+async def get_db_session():
+    """Context manager for database sessions"""
+    db = SessionLocal()
+    try:
+        yield db
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    finally:
+        await db.close()
+
+async def init_database():
+    """Create all tables if they don't exist"""
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+        # Seed the single counters row so the write path can always UPDATE it
+        async with SessionLocal() as db:
+            counters = (await db.execute(select(SystemCounters).limit(1))).scalars().first()
+            if counters is None:
+                db.add(SystemCounters())
+                await db.commit()
+
+        logger.info("Database tables created successfully")
+    except Exception as e:
+        logger.error(f"Failed to initialize database: {e}")
+        raise